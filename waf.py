@@ -1,17 +1,97 @@
 # waf.py (Phase 3: Basic Pattern Matching)
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+from requests.adapters import HTTPAdapter
+import http.cookiejar
 import json # For loading the configuration file
 import os   # For checking if config file exists
-from urllib.parse import urlparse, parse_qs # For parsing URL paths and query strings
+import socket
+import mmap
+import signal
+import sys
+import queue
+import logging
+import logging.handlers
+from urllib.parse import parse_qs, uses_params # For parsing query strings
+import string
+import ipaddress # For parsing blocked IPs / CIDR ranges
+from array import array
+from bisect import bisect_right
+try:
+    import orjson # C-accelerated JSON parser for the configuration file
+    _json_loads = orjson.loads # Parses straight from a memoryview, no copy
+except ImportError:
+    def _json_loads(data):
+        return json.loads(bytes(data)) # json.loads needs bytes/str, not a memoryview
+try:
+    import ahocorasick # pyahocorasick: multi-pattern substring search in one pass
+except ImportError:
+    ahocorasick = None
+try:
+    import re2 as _pattern_re # google-re2: linear-time regex engine, no catastrophic backtracking
+except ImportError:
+    import re as _pattern_re
+
+# --- Logging ---
+# Records are handed to a queue and written to stdout by a background thread (see setup_logging),
+# so request handlers never block on console I/O
+log = logging.getLogger("waf")
 
 # --- Configuration Loading ---
 CONFIG_FILE = 'config.json'
 CONFIG = {}
+_CONFIG_MTIME = None # mtime of the CONFIG_FILE version currently loaded in CONFIG
 LISTEN_PORT = 8080
 
+# --- Request Target Parsing (see _split_path) ---
+_SCHEME_FIRST_CHARS = frozenset(string.ascii_letters)
+_SCHEME_CHARS = string.ascii_letters + string.digits + "+-."
+_C0_CONTROL_OR_SPACE = ''.join(map(chr, range(0x21)))
+_PARAMS_SCHEMES = frozenset(uses_params) # Schemes whose URLs urlparse splits ";params" from
+
+# --- Hop-by-hop Headers ---
+# Request headers not forwarded to the origin ('host' is set by `requests` from the target URL)
+HOP_BY_HOP_REQ = frozenset({'host', 'proxy-connection', 'connection', 'keep-alive'})
+# Response headers not relayed back to the client
+HOP_BY_HOP_RESP = frozenset({'transfer-encoding', 'connection', 'proxy-authenticate', 'proxy-authorization',
+                             'te', 'trailers', 'upgrade', 'keep-alive'})
+
+# --- Block Response ---
+BLOCK_PREFIX = b"<h1>403 Forbidden: Access Denied by WAF</h1><p>"
+BLOCK_SUFFIX = b"</p>"
+# Fixed block reasons used by the handler; their 403 bodies are prebuilt in load_config
+# together with the configured rule reasons. Reasons with client-supplied text are built per call.
+REASON_DEFAULT = "Access Denied by WAF"
+REASON_HOST_MISSING = "Bad Request: Host header missing in original request."
+REASON_NOT_HTTP = "Bad Request: This WAF only forwards http:// URLs."
+REASON_PROXY_ERROR = "Internal Server Error while proxying"
+REASON_POST_UNSUPPORTED = "POST requests are not fully processed by this WAF version."
+REASON_HEAD_UNSUPPORTED = "HEAD requests are not fully processed by this WAF version."
+REASON_INTERNAL_ERROR = "Internal Server Error during request processing"
+FIXED_BLOCK_REASONS = (
+    REASON_DEFAULT,
+    REASON_HOST_MISSING,
+    REASON_NOT_HTTP,
+    REASON_PROXY_ERROR,
+    REASON_POST_UNSUPPORTED,
+    REASON_HEAD_UNSUPPORTED,
+    REASON_INTERNAL_ERROR,
+)
+
+# --- Upstream Connection Pool ---
+# One shared Session keeps connections to origin servers alive between requests,
+# so forwarding doesn't pay a new TCP handshake every time.
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=256))
+# The Session is shared by all clients: never store origin cookies in it, or one client's
+# Set-Cookie would be sent along with other clients' requests. Only the client's own Cookie header is forwarded.
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+# Response bodies are relayed undecoded, so the origin must only compress when the client asked for it:
+# drop the Session's default Accept-Encoding and forward just the client's own
+SESSION.headers.pop('Accept-Encoding', None)
+
 def load_config():
-    global CONFIG
+    global CONFIG, _CONFIG_MTIME
     # Default configuration in case the file is missing or malformed
     default_config = {
         "blocked_domains": [],
@@ -20,229 +100,426 @@ def load_config():
         "blocked_paths_for_specific_domain": {},
         "log_level": "INFO",
         "suspicious_query_patterns": [],
-        "blocked_user_agents": []
+        "blocked_user_agents": [],
+        "workers": 1
     }
+    # The new configuration is built in a local dict and published with a single assignment
+    # at the end, so handler threads never see a partially built CONFIG during a reload.
+    # A reload that fails leaves the current CONFIG in place; the defaults are only used on the first load.
+    mtime = None
     if os.path.exists(CONFIG_FILE):
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                CONFIG = json.load(f)
+            mtime = os.stat(CONFIG_FILE).st_mtime_ns
+            if CONFIG and mtime == _CONFIG_MTIME:
+                return # Unchanged since the last load: keep the already-built CONFIG
+            # Map the file and parse it in place instead of reading it into an intermediate bytes object
+            with open(CONFIG_FILE, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                    memoryview(mm) as view:
+                config = _json_loads(view)
             # Ensure all expected keys have defaults if missing in the loaded config
             for key, value in default_config.items():
-                CONFIG.setdefault(key, value)
-            print(f"Configuration successfully loaded from {CONFIG_FILE}")
+                config.setdefault(key, value)
+            try:
+                config["workers"] = int(config["workers"])
+                if config["workers"] < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                log.warning("Invalid workers value %r in configuration. Using 1.", config["workers"])
+                config["workers"] = 1
+            log.info("Configuration successfully loaded from %s", CONFIG_FILE)
         except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from {CONFIG_FILE}: {e}. Using default configuration.")
-            CONFIG = default_config
+            if CONFIG:
+                # Reload: never fall back to the empty defaults, keep enforcing the current rules
+                log.error("Error decoding JSON from %s: %s. Keeping the current configuration.", CONFIG_FILE, e)
+                return
+            log.error("Error decoding JSON from %s: %s. Using default configuration.", CONFIG_FILE, e)
+            config = default_config
+            mtime = None
         except Exception as e:
-            print(f"Error loading configuration from {CONFIG_FILE}: {e}. Using default configuration.")
-            CONFIG = default_config
+            if CONFIG:
+                log.error("Error loading configuration from %s: %s. Keeping the current configuration.", CONFIG_FILE, e)
+                return
+            log.error("Error loading configuration from %s: %s. Using default configuration.", CONFIG_FILE, e)
+            config = default_config
+            mtime = None
     else:
-        print(f"Warning: {CONFIG_FILE} not found. Using default configuration.")
-        CONFIG = default_config
+        if CONFIG:
+            log.error("%s not found. Keeping the current configuration.", CONFIG_FILE)
+            return
+        log.warning("%s not found. Using default configuration.", CONFIG_FILE)
+        config = default_config
+
+    # Convert the blocklists to frozensets once, so the per-request
+    # membership tests are hash lookups instead of list scans
+    for key in ("blocked_ips", "blocked_domains", "blocked_paths_for_all_domains", "blocked_user_agents"):
+        config[key] = frozenset(config[key])
+    config["blocked_paths_for_specific_domain"] = {
+        domain: frozenset(paths)
+        for domain, paths in config["blocked_paths_for_specific_domain"].items()
+    }
+    # blocked_ips entries may be single addresses or CIDR ranges ("10.0.0.0/8")
+    config["_blocked_ip_ranges"] = build_ip_ranges(config["blocked_ips"])
+    # Case-fold User-Agents and query patterns once here; requests only lowercase their own value
+    config["_blocked_ua_lower"] = frozenset(ua.lower() for ua in config["blocked_user_agents"])
+    config["_patterns_lower"] = tuple(p.lower() for p in config["suspicious_query_patterns"])
+    # Compile all suspicious query patterns into a single automaton
+    config["_suspicious_ac"] = build_pattern_automaton(config["suspicious_query_patterns"])
+    # Without pyahocorasick, fall back to one compiled alternation of all patterns
+    config["_patterns_by_lower"] = dict(zip(config["_patterns_lower"], config["suspicious_query_patterns"]))
+    config["_q_re"] = build_pattern_regex(config["_patterns_lower"]) if config["_suspicious_ac"] is None else None
+    # Single table for the exact-match rules, so each rule costs one dict lookup per request
+    config["_deny"] = build_deny_table(config)
+    # Every host/path/UA string that appears in some deny key: a request whose host, path and
+    # User-Agent are all absent from it can skip the per-rule lookups entirely
+    config["_deny_terms"] = frozenset(part for deny_key in config["_deny"] for part in deny_key[1:])
+    # Prebuilt 403 bodies for every reason that doesn't depend on the request
+    config["_block_bodies"] = {
+        reason: build_block_body(reason)
+        for reason in (*FIXED_BLOCK_REASONS, *config["_deny"].values())
+    }
+
+    CONFIG = config
+    _CONFIG_MTIME = mtime
+
+def build_block_body(reason_message):
+    """Return the HTML body of the 403 page for reason_message."""
+    return BLOCK_PREFIX + reason_message.encode() + BLOCK_SUFFIX
+
+def build_deny_table(config):
+    """Map every exact-match rule key to the block reason sent to the client.
+
+    Keys are ("dom", host), ("path", path), ("dompath", host, path) and ("ua", lowercased_ua).
+    """
+    deny = {}
+    for domain in config["blocked_domains"]:
+        deny[("dom", domain)] = f"Domain '{domain}' is blocked."
+    for path in config["blocked_paths_for_all_domains"]:
+        deny[("path", path)] = f"Path '{path}' is blocked for all domains."
+    for domain, paths in config["blocked_paths_for_specific_domain"].items():
+        for path in paths:
+            deny[("dompath", domain, path)] = f"Path '{path}' is blocked for domain '{domain}'."
+    for user_agent in config["blocked_user_agents"]:
+        deny[("ua", user_agent.lower())] = f"User-Agent '{user_agent}' is blocked."
+    return deny
+
+def build_ip_ranges(entries):
+    """Parse IPs/CIDRs into sorted, merged (starts, ends) interval arrays per IP version."""
+    intervals = {4: [], 6: []}
+    for entry in entries:
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            log.warning("Ignoring invalid entry in blocked_ips: %r", entry)
+            continue
+        intervals[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+    ranges = {}
+    for version, spans in intervals.items():
+        # IPv4 fits in unsigned 64-bit arrays; IPv6 needs arbitrary-size ints
+        starts = array('Q') if version == 4 else []
+        ends = array('Q') if version == 4 else []
+        for start, end in sorted(spans):
+            if ends and start <= ends[-1] + 1:
+                # Overlapping or adjacent range: extend the previous one
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        ranges[version] = (starts, ends)
+    return ranges
+
+def build_pattern_automaton(patterns):
+    """Build a case-insensitive Aho-Corasick automaton over the patterns (None if unavailable or empty)."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for pattern in patterns:
+        if pattern:
+            # Keys are lowercased for matching; the original pattern is kept for reporting
+            automaton.add_word(pattern.lower(), pattern)
+    if len(automaton) == 0:
+        return None
+    automaton.make_automaton()
+    return automaton
+
+def build_pattern_regex(patterns_lower):
+    """Compile the lowercased patterns into a single literal alternation (None if there are none)."""
+    alternatives = [_pattern_re.escape(p) for p in patterns_lower if p]
+    if not alternatives:
+        return None
+    return _pattern_re.compile("|".join(alternatives))
+
+def find_suspicious_pattern(value_str):
+    """Return the first suspicious pattern found in value_str (case-insensitive), or None."""
+    value_lower = value_str.lower()
+    automaton = CONFIG["_suspicious_ac"]
+    if automaton is not None:
+        hit = next(automaton.iter(value_lower), None)
+        return hit[1] if hit else None
+    # Fallback when pyahocorasick is not installed: one regex search over all patterns
+    regex = CONFIG["_q_re"]
+    if regex is None:
+        return None
+    match = regex.search(value_lower)
+    return CONFIG["_patterns_by_lower"][match.group(0)] if match else None
+
+def _split_path(url):
+    """Split a request target into (path, query) the way urlparse would, without building a ParseResult.
+
+    Handles both proxy-style absolute URLs ("http://example.com/page?query=1") and plain paths ("/page?query=1").
+    """
+    url = url.lstrip(_C0_CONTROL_OR_SPACE) # urlsplit ignores leading control characters and spaces
+    i = url.find('#')
+    if i >= 0:
+        url = url[:i]
+    query = ''
+    i = url.find('?')
+    if i >= 0:
+        query = url[i + 1:]
+        url = url[:i]
+    # Drop the scheme, if present (same rule as urlsplit: a letter, then scheme characters, then ':')
+    scheme = ''
+    i = url.find(':')
+    if i > 0 and url[0] in _SCHEME_FIRST_CHARS and not url[1:i].lstrip(_SCHEME_CHARS):
+        scheme = url[:i].lower()
+        url = url[i + 1:]
+    # Drop the netloc, if present
+    if url[:2] == '//':
+        i = url.find('/', 2)
+        url = url[i:] if i >= 0 else ''
+    # Like urlparse, ";params" on the last path segment are not part of the path
+    # (with no '/' at all, the whole path is the last segment)
+    if scheme in _PARAMS_SCHEMES:
+        i = url.find(';', max(url.rfind('/'), 0))
+        if i >= 0:
+            url = url[:i]
+    return url, query
+
+def ip_blocked(client_ip):
+    """Return True if client_ip falls inside any range from blocked_ips."""
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped # "::ffff:10.0.0.5" is checked as 10.0.0.5
+    starts, ends = CONFIG["_blocked_ip_ranges"][address.version]
+    value = int(address)
+    i = bisect_right(starts, value)
+    return i > 0 and value <= ends[i - 1]
 
 # --- WAF Request Handler ---
 class WAFRequestHandler(BaseHTTPRequestHandler):
+    # Set TCP_NODELAY on client sockets so small responses (e.g. 403 pages) aren't delayed by Nagle
+    disable_nagle_algorithm = True
     
-    def send_block_response(self, reason_message="Access Denied by WAF"):
+    def send_block_response(self, reason_message=REASON_DEFAULT):
         """Helper function to send a 403 Forbidden response."""
         # Log the block with client IP, host, and full path
         client_ip_for_log = self.client_address[0]
         host_for_log = self.headers.get('Host', 'N/A')
         path_for_log = self.path # self.path contains the full URL for proxy requests
 
-        print(f"--- Blocking request: {reason_message} (Client: {client_ip_for_log}, Host: {host_for_log}, Path: {path_for_log}) ---")
+        log.info("Blocking request: %s (Client: %s, Host: %s, Path: %s)",
+                 reason_message, client_ip_for_log, host_for_log, path_for_log)
         
+        body = CONFIG["_block_bodies"].get(reason_message)
+        if body is None:
+            body = build_block_body(reason_message) # Request-specific reason: not cached
+
         self.send_response(403)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(b"<h1>403 Forbidden: Access Denied by WAF</h1>")
-        self.wfile.write(f"<p>{reason_message}</p>".encode())
+        self.wfile.write(body) # Whole page in a single write
 
     def do_GET(self):
+        # Bind the config tables to locals once; load_config guarantees every key exists
+        cfg = CONFIG
+        deny = cfg["_deny"]
+        deny_terms = cfg["_deny_terms"]
+        query_patterns = cfg["suspicious_query_patterns"]
+
         client_ip = self.client_address[0]
-        target_host = self.headers.get('Host') # Original Host header from client
-        
-        # Use urlparse to reliably get the path and query components
+        # Lowercase each header name once; the lookups below and the forwarding filter reuse it
+        # (self.headers.get() would lowercase every header name again on each call)
+        header_items = [(key, key.lower(), value) for key, value in self.headers.items()]
+        headers_by_lower = {}
+        for key, l_key, value in header_items:
+            headers_by_lower.setdefault(l_key, value) # First occurrence wins, like self.headers.get()
+        target_host = headers_by_lower.get('host') # Original Host header from client
+
+        # Split out the path and query components
         # self.path from BaseHTTPRequestHandler for a proxy request is the full URL (e.g., "http://example.com/page?query=1")
-        parsed_url = urlparse(self.path)
-        actual_path_for_rules = parsed_url.path # e.g., "/page"
-        query_params = parse_qs(parsed_url.query) # e.g., {'query': ['1']}
-
-        # Logging request details
-        print(f"--- Request Received ---")
-        print(f"Client IP: {client_ip}")
-        print(f"Method: {self.command}")
-        print(f"Target Host Header: {target_host}") # Host header sent by client
-        print(f"Full Request Line (self.path): {self.path}")
-        print(f"Path for Rules (parsed_url.path): {actual_path_for_rules}")
-        print(f"Query Parameters: {query_params}")
+        actual_path_for_rules, query_string = _split_path(self.path) # e.g., "/page", "query=1"
+        # Query parameters are only parsed when there are query patterns to check them against
+        if query_patterns and query_string:
+            query_params = parse_qs(query_string) # e.g., {'query': ['1']}
+        else:
+            query_params = {}
+
+        # Logging request details (only formatted when DEBUG is enabled)
+        log.debug("Request received: Client IP: %s, Method: %s, Host: %s, Path: %s, Path for Rules: %s, Query Parameters: %s",
+                  client_ip, self.command, target_host, self.path, actual_path_for_rules, query_params)
 
         # --- Rule Checks ---
         # 1. Check IP Blocklist
-        if client_ip in CONFIG.get("blocked_ips", []):
+        if ip_blocked(client_ip):
             self.send_block_response(f"IP address {client_ip} is blocked.")
             return
 
         if not target_host:
-            self.send_block_response("Bad Request: Host header missing in original request.")
-            return
-
-        # 2. Check Domain Blocklist (based on Host header)
-        if target_host in CONFIG.get("blocked_domains", []):
-            self.send_block_response(f"Domain '{target_host}' is blocked.")
-            return
-
-        # 3. Check Blocked Paths (for all domains)
-        if actual_path_for_rules in CONFIG.get("blocked_paths_for_all_domains", []):
-            self.send_block_response(f"Path '{actual_path_for_rules}' is blocked for all domains.")
-            return
-
-        # 4. Check Blocked Paths (for specific domain)
-        domain_specific_blocked_paths = CONFIG.get("blocked_paths_for_specific_domain", {}).get(target_host, [])
-        if actual_path_for_rules in domain_specific_blocked_paths:
-            self.send_block_response(f"Path '{actual_path_for_rules}' is blocked for domain '{target_host}'.")
+            self.send_block_response(REASON_HOST_MISSING)
             return
 
-        # 5. Check Blocked User-Agents (Phase 3)
-        user_agent = self.headers.get('User-Agent', '')
-        for blocked_ua_pattern in CONFIG.get("blocked_user_agents", []):
-            # Using "in" for partial match, "==" for exact match.
-            # For this example we use exact match
-            if blocked_ua_pattern == user_agent: 
-                self.send_block_response(f"User-Agent '{user_agent}' is blocked.")
-                return
-            # For partial match:
-            # if blocked_ua_pattern.lower() in user_agent.lower():
-            #     self.send_block_response(f"User-Agent containing '{blocked_ua_pattern}' is blocked (Full UA: '{user_agent}').")
-            #     return
+        # 2-5. Exact-match rules, checked in order with one lookup each in the deny table:
+        # 2. Domain Blocklist (based on Host header)
+        # 3. Blocked Paths (for all domains)
+        # 4. Blocked Paths (for specific domain)
+        # 5. Blocked User-Agents (case-insensitive exact match)
+        user_agent = headers_by_lower.get('user-agent', '')
+        user_agent_lower = user_agent.lower() # Lowercase once per request
+        # Fast reject of the common case: nothing in this request appears in any rule
+        if (target_host in deny_terms or actual_path_for_rules in deny_terms
+                or user_agent_lower in deny_terms):
+            for deny_key in (("dom", target_host),
+                             ("path", actual_path_for_rules),
+                             ("dompath", target_host, actual_path_for_rules),
+                             ("ua", user_agent_lower)):
+                reason = deny.get(deny_key)
+                if reason is not None:
+                    self.send_block_response(reason)
+                    return
+        # For partial match:
+        # for blocked_ua_lower in CONFIG["_blocked_ua_lower"]:
+        #     if blocked_ua_lower in user_agent_lower:
+        #         self.send_block_response(f"User-Agent containing '{blocked_ua_lower}' is blocked (Full UA: '{user_agent}').")
+        #         return
 
         # 6. Check Suspicious Query Parameter Patterns
         for param_name, param_values_list in query_params.items():
             for value_str in param_values_list: # param_values_list is a list of strings
-                for pattern in CONFIG.get("suspicious_query_patterns", []):
-                    # Simple substring check. For case-insensitivity: pattern.lower() in value_str.lower()
-                    if pattern in value_str:
-                        self.send_block_response(f"Suspicious pattern '{pattern}' found in query parameter '{param_name}'. Value: '{value_str}'")
-                        return
+                # Case-insensitive substring check for all patterns at once
+                pattern = find_suspicious_pattern(value_str)
+                if pattern is not None:
+                    self.send_block_response(f"Suspicious pattern '{pattern}' found in query parameter '{param_name}'. Value: '{value_str}'")
+                    return
         # --- End Rule Checks ---
 
         # If not blocked, forward the request
         # The target_url for requests.get() should be the full URL from self.path
         target_url_for_forwarding = self.path 
-        print(f"--- Forwarding request to: {target_url_for_forwarding} (Original Host Header was: {target_host}) ---")
+        log.debug("Forwarding request to: %s (Original Host Header was: %s)", target_url_for_forwarding, target_host)
         
         try:
+            # Ensure the target URL is HTTP (this WAF version doesn't handle HTTPS forwarding)
+            # Only the 7-character scheme prefix is lowercased, not the whole URL
+            if target_url_for_forwarding[:7].lower() != "http://":
+                self.send_block_response(REASON_NOT_HTTP)
+                return
+
             # Prepare headers for the outgoing request:
             # - Remove 'Host' because 'requests' will set it based on target_url_for_forwarding's netloc.
             # - Remove other hop-by-hop headers not suitable for forwarding.
-            forward_headers = {key: value for key, value in self.headers.items()
-                               if key.lower() not in ['host', 'proxy-connection', 'connection', 'keep-alive']}
+            forward_headers = {key: value for key, l_key, value in header_items
+                               if l_key not in HOP_BY_HOP_REQ}
 
-            # Ensure the target URL is HTTP (this WAF version doesn't handle HTTPS forwarding)
-            if not target_url_for_forwarding.lower().startswith("http://"):
-                self.send_block_response("Bad Request: This WAF only forwards http:// URLs.")
-                return
+            # Using timeout for the pooled SESSION.get; stream=True so the body is relayed
+            # chunk by chunk instead of being buffered in memory first
+            with SESSION.get(target_url_for_forwarding, headers=forward_headers, allow_redirects=False,
+                             timeout=10, stream=True) as resp:
+                self.send_response(resp.status_code)
+
+                # Relay relevant headers from the target server's response back to the client
+                # Skip hop-by-hop headers and headers that will be managed by this proxy or `requests`
+                skipped_headers_debug = []
+                sent_headers_debug = {}
+
+                # resp.raw.headers (urllib3's HTTPHeaderDict) yields repeated headers such as Set-Cookie
+                # one by one under the origin's own names; resp.headers would join them into one line
+                for key, value in resp.raw.headers.items():
+                    # The body is relayed undecoded, so the original Content-Encoding and
+                    # Content-Length stay valid and are passed through.
+                    # Transfer-Encoding is hop-by-hop; the body is relayed de-chunked.
+                    if key.lower() in HOP_BY_HOP_RESP:
+                        skipped_headers_debug.append(f"Skipping hop-by-hop header: {key}")
+                        continue
+
+                    self.send_header(key, value)
+                    sent_headers_debug[key] = value
+
+                if 'Content-Length' not in resp.headers:
+                    # No length from the origin: this HTTP/1.0 handler delimits the body by closing the connection
+                    self.close_connection = True
 
-            # Using timeout for requests.get
-            resp = requests.get(target_url_for_forwarding, headers=forward_headers, allow_redirects=False, timeout=10)
-
-            self.send_response(resp.status_code)
-            
-            # Relay relevant headers from the target server's response back to the client
-            # Skip hop-by-hop headers and headers that will be managed by this proxy or `requests`
-            skipped_headers_debug = [] 
-            sent_headers_debug = {}    
-
-            for key, value in resp.headers.items():
-                l_key = key.lower()
-                # If `requests` decompresses content (default without stream=True), don't send original Content-Encoding.
-                # Our current forwarding logic (using resp.content) means requests decompresses.
-                if l_key == 'content-encoding': 
-                    skipped_headers_debug.append(f"Skipping original Content-Encoding header: {value}")
-                    continue 
-                # Transfer-Encoding is hop-by-hop.
-                if l_key == 'transfer-encoding':
-                    skipped_headers_debug.append(f"Skipping original Transfer-Encoding header: {value}")
-                    continue
-                # We will set our own Content-Length based on resp.content.
-                if l_key == 'content-length':
-                    skipped_headers_debug.append(f"Skipping original Content-Length header: {value}")
-                    continue
-                # Other common hop-by-hop headers
-                if l_key in ['connection', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'upgrade', 'keep-alive']:
-                    skipped_headers_debug.append(f"Skipping hop-by-hop header: {key}")
-                    continue
-                
-                self.send_header(key, value)
-                sent_headers_debug[key] = value
-            
-            body_bytes = resp.content # This gets the full body, decompressed by `requests`
-            self.send_header('Content-Length', str(len(body_bytes)))
-            sent_headers_debug['Content-Length'] = str(len(body_bytes))
-
-            # For debugging header handling:
-            # print(f"DEBUG: Skipped response headers: {skipped_headers_debug}")
-            # print(f"DEBUG: Sent response headers: {sent_headers_debug}")
-
-            self.end_headers()
-            self.wfile.write(body_bytes)
+                # For debugging header handling:
+                # log.debug("Skipped response headers: %s", skipped_headers_debug)
+                # log.debug("Sent response headers: %s", sent_headers_debug)
+
+                self.end_headers()
+                try:
+                    # decode_content=False relays the bytes exactly as the origin encoded them
+                    for chunk in resp.raw.stream(65536, decode_content=False):
+                        self.wfile.write(chunk)
+                except Exception as e_stream:
+                    # The status line is already sent, so a 403 page can't follow: just drop the connection
+                    log.warning("Error relaying response body for %s: %s", target_url_for_forwarding, e_stream)
+                    self.close_connection = True
 
         except requests.exceptions.Timeout:
-            print(f"Timeout error forwarding request for {target_url_for_forwarding}")
+            log.warning("Timeout error forwarding request for %s", target_url_for_forwarding)
             self.send_block_response(f"Gateway Timeout: Could not connect to {target_host if target_host else 'the target server'} in time.")
         except requests.exceptions.RequestException as e:
-            print(f"Error forwarding request for {target_url_for_forwarding}: {e}")
+            log.warning("Error forwarding request for %s: %s", target_url_for_forwarding, e)
             self.send_block_response(f"Bad Gateway: Could not connect to {target_host if target_host else 'the target server'}")
         except Exception as e_general:
-            print(f"General error during forwarding for {target_url_for_forwarding}: {e_general}")
-            self.send_block_response("Internal Server Error while proxying")
+            log.error("General error during forwarding for %s: %s", target_url_for_forwarding, e_general)
+            self.send_block_response(REASON_PROXY_ERROR)
 
     def do_POST(self):
         client_ip = self.client_address[0]
         target_host = self.headers.get('Host')
-        print(f"--- POST Request Received --- Client IP: {client_ip}, Host: {target_host}, Path: {self.path}")
+        log.debug("POST Request Received: Client IP: %s, Host: %s, Path: %s", client_ip, target_host, self.path)
 
         # Apply IP and User-Agent blocking for POST as well
-        if client_ip in CONFIG.get("blocked_ips", []):
+        if ip_blocked(client_ip):
             self.send_block_response(f"IP address {client_ip} is blocked (POST).")
             return
         
         user_agent = self.headers.get('User-Agent', '')
-        for blocked_ua in CONFIG.get("blocked_user_agents", []):
-            if blocked_ua == user_agent: # Exact match
-                self.send_block_response(f"User-Agent '{user_agent}' is blocked (POST).")
-                return
+        if user_agent.lower() in CONFIG["_blocked_ua_lower"]: # Case-insensitive exact match
+            self.send_block_response(f"User-Agent '{user_agent}' is blocked (POST).")
+            return
         
         # POST body inspection and forwarding is more complex.
         # For now, block POSTs that haven't been IP/UA blocked.
-        self.send_block_response("POST requests are not fully processed by this WAF version.")
+        self.send_block_response(REASON_POST_UNSUPPORTED)
 
     def do_HEAD(self):
         client_ip = self.client_address[0]
         target_host = self.headers.get('Host')
-        print(f"--- HEAD Request Received --- Client IP: {client_ip}, Host: {target_host}, Path: {self.path}")
+        log.debug("HEAD Request Received: Client IP: %s, Host: %s, Path: %s", client_ip, target_host, self.path)
 
         # Apply IP and User-Agent blocking for HEAD
-        if client_ip in CONFIG.get("blocked_ips", []):
+        if ip_blocked(client_ip):
             self.send_block_response(f"IP address {client_ip} is blocked (HEAD).")
             return
 
         user_agent = self.headers.get('User-Agent', '')
-        for blocked_ua in CONFIG.get("blocked_user_agents", []):
-            if blocked_ua == user_agent: # Exact match
-                self.send_block_response(f"User-Agent '{user_agent}' is blocked (HEAD).")
-                return
+        if user_agent.lower() in CONFIG["_blocked_ua_lower"]: # Case-insensitive exact match
+            self.send_block_response(f"User-Agent '{user_agent}' is blocked (HEAD).")
+            return
         
         # HEAD request forwarding would involve making a GET, getting headers, but not body.
         # For simplicity, we can block them if not IP/UA blocked.
-        self.send_block_response("HEAD requests are not fully processed by this WAF version.")
+        self.send_block_response(REASON_HEAD_UNSUPPORTED)
 
     def handle_one_request(self):
         try:
             super().handle_one_request()
         except ConnectionResetError:
             # This can happen if the client closes the connection abruptly
-            print(f"Connection reset by client: {self.client_address}")
+            log.info("Connection reset by client: %s", self.client_address)
         except Exception as e:
             # Catch-all for other errors during request handling by http.server
             # self.command might not be set if error is very early
@@ -251,53 +528,115 @@ class WAFRequestHandler(BaseHTTPRequestHandler):
             client_addr_attr = getattr(self, 'client_address', ('Unknown IP', 0))
 
             if command_attr not in ['GET', 'POST', 'HEAD']:
-                print(f"--- {command_attr} Request Received --- Client IP: {client_addr_attr[0]}, Path: {path_attr}")
+                log.debug("%s Request Received: Client IP: %s, Path: %s", command_attr, client_addr_attr[0], path_attr)
                 # Try to send a block response if possible
                 if not getattr(self.wfile, 'closed', True): # Check if wfile is available and not closed
                     try:
                         self.send_block_response(f"Unsupported method ('{command_attr}')")
                     except Exception as e_send:
-                        print(f"Error sending block response for unsupported method: {e_send}")
+                        log.error("Error sending block response for unsupported method: %s", e_send)
                 else:
-                    print("wfile closed, cannot send block response for unsupported method.")
+                    log.warning("wfile closed, cannot send block response for unsupported method.")
             else:
                 # For errors within implemented methods that weren't caught by their own try-except
-                print(f"Unhandled exception in request handling for {command_attr} {path_attr}: {e}")
+                log.error("Unhandled exception in request handling for %s %s: %s", command_attr, path_attr, e)
                 if not getattr(self.wfile, 'closed', True):
                     try:
-                        self.send_block_response("Internal Server Error during request processing")
+                        self.send_block_response(REASON_INTERNAL_ERROR)
                     except Exception as e_send_final:
-                        print(f"Error sending final Internal Server Error response: {e_send_final}")
+                        log.error("Error sending final Internal Server Error response: %s", e_send_final)
     
-    # Suppress default http.server logging to avoid duplicate log lines with our custom prints
+    # Suppress default http.server logging to avoid duplicate log lines with our "waf" logger
     def log_message(self, format, *args):
         # Enable this for the default logging format,
-        # but it might be redundant with the custom print statements.
+        # but it might be redundant with the "waf" logger output.
         # super().log_message(format, *args)
         pass
 
+# --- WAF Server ---
+class WAFHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with a larger accept backlog and SO_REUSEPORT on the listening socket."""
+    request_queue_size = 2048
+
+    def server_bind(self):
+        # Lets several independent WAF processes bind the same port; the kernel balances accepts between them
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
 # --- Main WAF Runner ---
-def run_waf(server_class=HTTPServer, handler_class=WAFRequestHandler, port=LISTEN_PORT):
-    print("--- RUN_WAF FUNCTION CALLED (WAF Startup Sequence) ---") 
-    
+def setup_logging(level=logging.INFO):
+    """Route the "waf" logger through a QueueHandler; the returned listener writes to stdout.
+
+    Replaces any handler installed by a previous call, so each process can set up its own listener after forking.
+    """
+    log_queue = queue.SimpleQueue()
+    log.handlers.clear()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+def run_waf(server_class=WAFHTTPServer, handler_class=WAFRequestHandler, port=LISTEN_PORT):
+    log_listener = setup_logging()
+    log.info("--- RUN_WAF FUNCTION CALLED (WAF Startup Sequence) ---")
+
     load_config() # Load configuration at startup
-    print(f"--- CONFIGURATION LOADED (Blocked IPs: {CONFIG.get('blocked_ips')}) ---")
-    
-    actual_port = CONFIG.get("listen_port", port) 
-    print(f"--- WAF WILL LISTEN ON PORT: {actual_port} ---")
+    try:
+        log.setLevel(str(CONFIG.get("log_level", "INFO")).upper())
+    except ValueError:
+        log.warning("Unknown log_level %r in configuration. Using INFO.", CONFIG.get("log_level"))
+    log.info("--- CONFIGURATION LOADED (Blocked IPs: %s) ---", sorted(CONFIG.get('blocked_ips')))
+
+    actual_port = CONFIG.get("listen_port", port)
+    log.info("--- WAF WILL LISTEN ON PORT: %s ---", actual_port)
 
-    server_address = ('', actual_port) 
+    server_address = ('', actual_port)
     httpd = server_class(server_address, handler_class)
-    print(f"Starting WAF on port {actual_port}...")
+
+    # Prefork: workers are forked after CONFIG is built and the socket is bound, so they
+    # share the parsed rule tables copy-on-write and accept from the same listening socket
+    workers = CONFIG["workers"] if hasattr(os, "fork") else 1
+    worker_pids = []
+    is_worker = False
+    if workers > 1:
+        # Don't fork with the listener thread running; every process starts its own below
+        log_listener.stop()
+        for _ in range(workers - 1):
+            pid = os.fork()
+            if pid == 0:
+                is_worker = True
+                worker_pids = []
+                break
+            worker_pids.append(pid)
+        log_listener = setup_logging(log.level)
+        # Turn SIGTERM into a normal shutdown: the parent (e.g. on `docker stop`) then stops its workers,
+        # and the workers (stopped by the parent) flush their queued log records before exiting
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log.info("Starting WAF on port %s (pid %s)...", actual_port, os.getpid())
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
-        print("\nStopping WAF (KeyboardInterrupt).")
+        log.info("Stopping WAF (KeyboardInterrupt).")
     except Exception as e:
-        print(f"WAF server error: {e}")
+        log.error("WAF server error: %s", e)
     finally:
         httpd.server_close()
-        print("WAF server stopped.")
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        log.info("WAF server stopped.")
+        log_listener.stop()
+        if is_worker:
+            os._exit(0) # Don't run the parent's remaining code in a forked worker
 
 if __name__ == '__main__':
     run_waf()